@@ -1,16 +1,145 @@
 import geopandas as gpd
 from pyproj import CRS
-from shapely.geometry import LineString
+import numpy as np
+import pandas as pd
+import shapely
 import logging
 import glob
 import os
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 # Setup logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+# Threads available to _parallel_apply, lowered in the worker processes of _main
+_max_threads = os.cpu_count() or 1
+
+
+def _limit_threads(max_threads):
+    """
+    Sets the number of threads _parallel_apply may use in this process.
+    """
+    global _max_threads
+    _max_threads = max_threads
+
+
+def _parallel_apply(func, *arrays, min_chunk_size=10000):
+    """
+    Applies a vectorized shapely function to aligned arrays, splitting them into chunks
+    that run on a thread pool. Shapely releases the GIL while GEOS works, so the chunks
+    are computed concurrently. Small inputs are processed in a single call.
+    """
+    n_chunks = min(_max_threads, len(arrays[0]) // min_chunk_size)
+    if n_chunks <= 1:
+        return func(*arrays)
+
+    chunks = zip(*(np.array_split(array, n_chunks) for array in arrays))
+    with ThreadPoolExecutor(max_workers=n_chunks) as executor:
+        results = list(executor.map(lambda chunk: func(*chunk), chunks))
+    return np.concatenate(results)
+
+
+def _polygonal_parts(geoms):
+    """
+    Keeps only the polygons of geometry collections, dropping the lines and points GEOS
+    returns where two polygons also touch outside their overlap. This matches the output
+    of gpd.overlay(..., how="intersection").
+    """
+    collections = np.flatnonzero(shapely.get_type_id(geoms) == 7)
+    if len(collections) == 0:
+        return geoms
+
+    # Flatten the collections down to single parts, remembering which one each came from
+    parts, part_index = shapely.get_parts(geoms[collections], return_index=True)
+    parts, sub_index = shapely.get_parts(parts, return_index=True)
+    part_index = part_index[sub_index]
+
+    # Collections without any polygon part are left as None
+    merged = np.empty(len(collections), dtype=object)
+    polygon_mask = shapely.get_type_id(parts) == 3
+    if polygon_mask.any():
+        shapely.multipolygons(
+            parts[polygon_mask], indices=part_index[polygon_mask], out=merged
+        )
+        single = shapely.get_num_geometries(merged) == 1
+        merged[single] = shapely.get_geometry(merged[single], 0)
+
+    geoms = geoms.copy()
+    geoms[collections] = merged
+    return geoms
+
+
+def _spatial_tiles(bounds, grid_size=16, min_features=1000000):
+    """
+    Splits geometries into a grid_size x grid_size grid over their total extent, by the
+    center of their envelopes, and returns the positions of the geometries in each
+    non-empty cell. Missing and empty geometries have NaN bounds and can not overlap
+    anything, so they are left out. Inputs smaller than min_features are returned as a
+    single tile.
+
+    Every tile is still queried against the spatial index of the whole input, so tiling
+    only bounds the size of the pair arrays; it does not make the check faster.
+    """
+    if len(bounds) < min_features:
+        return [np.arange(len(bounds))]
+
+    valid_idx = np.flatnonzero(~np.isnan(bounds).any(axis=1))
+    if len(valid_idx) == 0:
+        return [valid_idx]
+
+    centers = (bounds[valid_idx, :2] + bounds[valid_idx, 2:]) / 2
+    origin = centers.min(axis=0)
+    extent = centers.max(axis=0) - origin
+    extent[extent == 0] = 1
+    cells = (centers - origin) / extent * grid_size
+    cells = np.minimum(cells, grid_size - 1).astype(int)
+    cell_ids = cells[:, 1] * grid_size + cells[:, 0]
+
+    order = np.argsort(cell_ids, kind="stable")
+    _, starts = np.unique(cell_ids[order], return_index=True)
+    return np.split(valid_idx[order], starts[1:])
+
+
+def _overlap_pairs(geoms, ids, bounds, sindex, tile_idx, threshold):
+    """
+    Finds the pairs of overlapping geometries whose first member is in tile_idx and
+    whose overlap area is at least threshold. Each unordered pair is reported once,
+    from the tile of its lower position, and pairs sharing the same id are skipped.
+
+    Returns the positions of both members, the overlap geometries and their areas.
+    """
+    # One bulk envelope query for all candidate pairs, keeping each pair once
+    input_idx, right_idx = sindex.query(geoms[tile_idx])
+    left_idx = tile_idx[input_idx]
+    pair_mask = (left_idx < right_idx) & (ids[left_idx] != ids[right_idx])
+    left_idx, right_idx = left_idx[pair_mask], right_idx[pair_mask]
+
+    # An overlap can not be larger than the intersection of the two envelopes
+    lower = np.maximum(bounds[left_idx, :2], bounds[right_idx, :2])
+    upper = np.minimum(bounds[left_idx, 2:], bounds[right_idx, 2:])
+    envelope_mask = (upper - lower).clip(0).prod(axis=1) >= threshold
+    left_idx, right_idx = left_idx[envelope_mask], right_idx[envelope_mask]
+
+    # Discard pairs that only touch or where one geometry contains the other
+    overlaps_mask = _parallel_apply(shapely.overlaps, geoms[left_idx], geoms[right_idx])
+    left_idx, right_idx = left_idx[overlaps_mask], right_idx[overlaps_mask]
+
+    intersections = _parallel_apply(
+        shapely.intersection, geoms[left_idx], geoms[right_idx]
+    )
+    intersections = _polygonal_parts(intersections)
+    areas = _parallel_apply(shapely.area, intersections)
+
+    area_mask = areas >= threshold
+    return (
+        left_idx[area_mask],
+        right_idx[area_mask],
+        intersections[area_mask],
+        areas[area_mask],
+    )
+
 
 def check_overlap(gdf, id_col=None, threshold=0):
     """
@@ -34,62 +163,37 @@ def check_overlap(gdf, id_col=None, threshold=0):
                 "GeoDataFrame is in a geographic CRS. Consider reprojecting to a projected CRS for accurate area measurements."
             )
 
-        if id_col == None:
-            gdf["id"] = range(1, len(gdf) + 1)
+        if id_col is None:
+            ids = np.arange(1, len(gdf) + 1)
             id_col = "id"
-
-        gdf["temp_index"] = gdf.index
-        spatial_index = gdf.sindex
-        data_overlaps = []
-
-        for index, row in gdf.iterrows():
-            try:
-                possible_matches_index = list(
-                    spatial_index.intersection(row.geometry.bounds)
-                )
-            except Exception as e:
-                logging.warning(f"Error when looking for intersection : {e}")
-                continue
-            possible_matches = gdf.iloc[possible_matches_index].copy()
-            possible_overlaps = possible_matches[
-                possible_matches.geometry.overlaps(row.geometry)
-            ]
-
-            for _, possible_overlap_row in possible_overlaps.iterrows():
-                if possible_overlap_row[id_col] == row[id_col]:
-                    continue
-
-                intersection = gpd.overlay(
-                    gdf.loc[[index]],
-                    gdf.loc[[possible_overlap_row["temp_index"]]],
-                    how="intersection",
-                )
-                intersection["area"] = intersection.geometry.area
-
-                if intersection["area"].iloc[0] >= threshold:
-                    sorted_ids = sorted([row[id_col], possible_overlap_row[id_col]])
-                    if sorted_ids not in data_overlaps:
-                        data_overlaps.append(
-                            sorted_ids
-                            + [
-                                intersection.geometry.iloc[0],
-                                intersection["area"].iloc[0],
-                            ]
-                        )
-
-        if data_overlaps:
-            overlaps_gdf = gpd.GeoDataFrame(
-                data_overlaps,
-                columns=[f"{id_col}_1", f"{id_col}_2", "geometry", "area"],
-                crs=gdf.crs,
-            )
         else:
-            overlaps_gdf = gpd.GeoDataFrame(
-                columns=[f"{id_col}_1", f"{id_col}_2", "geometry", "area"], crs=gdf.crs
-            )
+            ids = gdf[id_col].to_numpy()
 
-        del gdf["temp_index"]
-        overlaps_gdf.drop_duplicates(inplace=True, ignore_index=True)
+        geoms = gdf.geometry.to_numpy()
+
+        bounds = shapely.bounds(geoms)
+
+        # Large inputs are processed tile by tile so the pair arrays stay small
+        tiles = [
+            _overlap_pairs(geoms, ids, bounds, gdf.sindex, tile_idx, threshold)
+            for tile_idx in _spatial_tiles(bounds)
+        ]
+        left_idx, right_idx, intersections, areas = (
+            np.concatenate(arrays) for arrays in zip(*tiles)
+        )
+
+        left_ids, right_ids = ids[left_idx], ids[right_idx]
+        swap = left_ids > right_ids
+
+        overlaps_gdf = gpd.GeoDataFrame(
+            {
+                f"{id_col}_1": np.where(swap, right_ids, left_ids),
+                f"{id_col}_2": np.where(swap, left_ids, right_ids),
+                "geometry": intersections,
+                "area": areas,
+            },
+            crs=gdf.crs,
+        )
         return overlaps_gdf
 
     except Exception as e:
@@ -110,15 +214,18 @@ def check_gap(gdf, id_col):
     - GeoDataFrame containing the identified gaps and the IDs of features touching each gap.
     """
     try:
-        if id_col == None:
-            gdf["id"] = range(1, len(gdf) + 1)
+        if id_col is None:
+            ids = np.arange(1, len(gdf) + 1)
             id_col = "id"
+        else:
+            ids = gdf[id_col].to_numpy()
 
-        gdf_copy = gdf.copy()
-        gdf_copy["diss_id"] = 1
-        data_temp_diss = gdf_copy.dissolve(by="diss_id")
+        unioned = shapely.union_all(gdf.geometry.to_numpy())
+        polygons = shapely.get_parts(unioned)
+        ring_counts = shapely.get_num_interior_rings(polygons)
+        n_interiors = ring_counts.sum()
 
-        if not data_temp_diss.interiors.values.tolist():
+        if not n_interiors:
             logging.warning(
                 "No interiors found. The provided GeoDataFrame might not have gaps."
             )
@@ -126,18 +233,32 @@ def check_gap(gdf, id_col):
                 columns=[f"{id_col}_1", f"{id_col}_2", "geometry", "area"], crs=gdf.crs
             )
 
-        interiors = data_temp_diss.interiors.values.tolist()[0]
-        gap_list = [LineString(i) for i in interiors]
+        # Pair every interior ring with the polygon part it belongs to
+        polygon_idx = np.repeat(np.arange(len(polygons)), ring_counts)
+        ring_no = np.arange(n_interiors) - np.repeat(
+            np.cumsum(ring_counts) - ring_counts, ring_counts
+        )
+        interiors = shapely.get_interior_ring(polygons[polygon_idx], ring_no)
+        coords, ring_idx = shapely.get_coordinates(interiors, return_index=True)
+        gap_list = shapely.linestrings(coords, indices=ring_idx)
         data_gaps = gpd.GeoDataFrame(geometry=gap_list, crs=gdf.crs)
-        gdf_sindex = gdf_copy.sindex
 
-        data_gaps["feature_touches"] = data_gaps.geometry.apply(
-            lambda gap_geom: gdf_copy.iloc[
-                list(gdf_sindex.query(gap_geom, predicate="touches"))
-            ][id_col].tolist()
+        gap_idx, feature_idx = gdf.sindex.query(gap_list, predicate="touches")
+        touches = (
+            pd.Series(ids[feature_idx])
+            .groupby(gap_idx)
+            .agg(lambda gap_ids: gap_ids.tolist())
+            .reindex(range(len(gap_list)))
+            .astype(object)
+        )
+        # Gaps without any touching feature get an empty list, not NaN
+        missing = touches.isna()
+        touches[missing] = pd.Series(
+            [[] for _ in range(missing.sum())], index=touches.index[missing]
         )
+        data_gaps["feature_touches"] = touches
 
-        data_gaps.drop_duplicates(inplace=True, ignore_index=True)
+        data_gaps.drop_duplicates(subset="geometry", inplace=True, ignore_index=True)
         return data_gaps
 
     except Exception as e:
@@ -167,95 +288,129 @@ def check_containment(gdf, id_col, min_area=0):
                 "GeoDataFrame is in a geographic CRS. Consider reprojecting to a projected CRS for accurate area measurements."
             )
 
-        if id_col == None:
-            gdf["id"] = range(1, len(gdf) + 1)
+        if id_col is None:
+            ids = np.arange(1, len(gdf) + 1)
             id_col = "id"
+        else:
+            ids = gdf[id_col].to_numpy()
 
-        gdf["temp_index"] = gdf.index
-        spatial_index = gdf.sindex
-        data_containment = []
+        geoms = gdf.geometry.to_numpy()
 
-        for _, row in gdf.iterrows():
-            possible_matches_index = list(
-                spatial_index.query(row.geometry, predicate="contains")
-            )
-            possible_matches = gdf.iloc[possible_matches_index].copy()
-
-            for _, possible_contained_row in possible_matches.iterrows():
-                drop = 0
-                if possible_contained_row[id_col] == row[id_col]:
-                    continue
-
-                if row.geometry.contains(possible_contained_row.geometry):
-                    area = possible_contained_row.geometry.area
-                    if area == row.geometry.area:
-                        drop = 1
-                    if area >= min_area:
-                        sorted_ids = sorted(
-                            [row[id_col], possible_contained_row[id_col]]
-                        )
-                        if sorted_ids not in data_containment:
-                            data_containment.append(
-                                sorted_ids
-                                + [possible_contained_row.geometry, area, drop]
-                            )
-
-        if data_containment:
-            containment_gdf = gpd.GeoDataFrame(
-                data_containment,
-                columns=[f"{id_col}_1", f"{id_col}_2", "geometry", "area", "drop"],
-                crs=gdf.crs,
-            )
-        else:
-            containment_gdf = gpd.GeoDataFrame(
-                columns=[f"{id_col}_1", f"{id_col}_2", "geometry", "area", "drop"],
-                crs=gdf.crs,
-            )
+        areas = _parallel_apply(shapely.area, geoms)
 
-        del gdf["temp_index"]
-        containment_gdf.drop_duplicates(inplace=True, ignore_index=True)
+        # Self-pairs are dropped before the predicate, a geometry tested against itself
+        # forces GEOS into a full relate computation
+        container_idx, contained_idx = gdf.sindex.query(geoms)
+        mask = (
+            (container_idx != contained_idx)
+            & (ids[container_idx] != ids[contained_idx])
+            & (areas[contained_idx] >= min_area)
+        )
+        container_idx, contained_idx = container_idx[mask], contained_idx[mask]
+
+        # The geometries are the caller's objects, so only containers that were not
+        # already prepared are prepared here and released again afterwards. The
+        # prepared test runs on this thread, GEOS builds prepared indexes lazily.
+        containers = geoms[np.unique(container_idx)]
+        containers = containers[~shapely.is_prepared(containers)]
+        shapely.prepare(containers)
+        try:
+            contains_mask = shapely.contains(geoms[container_idx], geoms[contained_idx])
+        finally:
+            shapely.destroy_prepared(containers)
+        container_idx, contained_idx = (
+            container_idx[contains_mask],
+            contained_idx[contains_mask],
+        )
+        drop = np.isclose(areas[contained_idx], areas[container_idx]).astype(int)
+
+        # Equal geometries contain each other, keep only the first of each pair
+        low = np.minimum(container_idx, contained_idx).astype(np.int64)
+        high = np.maximum(container_idx, contained_idx)
+        pair_keys = low * len(geoms) + high
+        _, first = np.unique(pair_keys, return_index=True)
+        first.sort()
+
+        container_ids, contained_ids = (
+            ids[container_idx[first]],
+            ids[contained_idx[first]],
+        )
+        swap = container_ids > contained_ids
+
+        containment_gdf = gpd.GeoDataFrame(
+            {
+                f"{id_col}_1": np.where(swap, contained_ids, container_ids),
+                f"{id_col}_2": np.where(swap, container_ids, contained_ids),
+                "geometry": geoms[contained_idx[first]],
+                "area": areas[contained_idx[first]],
+                "drop": drop[first],
+            },
+            crs=gdf.crs,
+        )
         return containment_gdf
     except Exception as e:
         logging.error("Failed in check_containment: %s", e)
         raise
 
 
-def _main():
+def _run_function(file):
     """
-    Example for my final project haha
+    Runs the overlap and containment checks on one file and writes the results next to it.
+    Defined at module level so it can be pickled for the process pool in _main.
     """
+    logging.info("Starting %s!", file)
+    gdf = gpd.read_file(file, engine="pyogrio")
+    epsg = 32748
+
+    # Compare authority codes, CRS equality can fall back to comparing full WKT
+    if gdf.crs is None or gdf.crs.to_epsg() != epsg:
+        gdf = gdf.to_crs(epsg=epsg)
+
+    overlaps_gdf = check_overlap(gdf, "bID", 0.5)
+    if len(overlaps_gdf) > 0:
+        overlaps_gdf.to_file(
+            file.replace("_1.geojson", "_overlaps_fin.geojson"),
+            driver="GeoJSON",
+            engine="pyogrio",
+        )
+    else:
+        logging.warning("No overlaps found in %s", file)
+
+    containment_gdf = check_containment(gdf, "bID", 0.5)
+    if len(containment_gdf) > 0:
+        containment_gdf.to_file(
+            file.replace("_1.geojson", "_containment_fin.geojson"),
+            driver="GeoJSON",
+            engine="pyogrio",
+        )
+    else:
+        logging.warning("No containments found in %s", file)
 
-    def run_function(file):
-        logging.info("Starting %s!", file)
-        gdf = gpd.read_file(file)
-        crs = "EPSG:32748"
-
-        if gdf.crs != crs:
-            gdf = gdf.to_crs(crs)
-
-        overlaps_gdf = check_overlap(gdf, "bID", 0.5)
-        if len(overlaps_gdf) > 0:
-            overlaps_gdf.to_file(
-                file.replace("_1.geojson", "_overlaps_fin.geojson"), driver="GeoJSON"
-            )
-        else:
-            logging.warning("No overlaps found in %s", file)
-
-        containment_gdf = check_containment(gdf, "bID", 0.5)
-        if len(containment_gdf) > 0:
-            containment_gdf.to_file(
-                file.replace("_1.geojson", "_containment_fin.geojson"), driver="GeoJSON"
-            )
-        else:
-            logging.warning("No containments found in %s", file)
+    logging.info("Succeed : %s", file)
 
-        logging.info("Succeed : %s", file)
 
+def _main():
+    """
+    Example for my final project haha
+    """
     try:
         files_path = r"Data Collection\building_clean"
         files = glob.glob(os.path.join(files_path, "*_1.geojson"))
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = [executor.submit(run_function, file) for file in files]
+        n_cpus = os.cpu_count() or 1
+        n_workers = max(1, min(n_cpus, len(files)))
+
+        # Split the CPUs between the processes so their GEOS threads do not oversubscribe
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_limit_threads,
+            initargs=(max(1, n_cpus // n_workers),),
+        ) as executor:
+            futures = {executor.submit(_run_function, file): file for file in files}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error("Failed on %s: %s", futures[future], e)
 
     except Exception as e:
         logging.error("Failed in main: %s", e)